@@ -1,14 +1,23 @@
 import base64
+import hashlib
 import io
 import logging
+import orjson
 import re
 import requests
-from codecs import *
+import threading
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from copy import deepcopy
 from datetime import datetime
-from difflib import SequenceMatcher
 from flask import request, jsonify, json
-from urllib.parse import *
+from itertools import islice
+from rapidfuzz import process
+from rapidfuzz.distance import Indel
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
+from urllib3.util.retry import Retry
 
 from exceptionservice import app
 from exceptionservice.config import *
@@ -16,6 +25,8 @@ from exceptionservice.config import *
 MAX_SUMMARY_LENGTH = 255
 MAX_DESCRIPTION_LENGTH = 32767 - 767  # Max chars but trim only the stacktrace so leave enough room for other text
 BLACKLISTED_CHARACTERS = "'\"+-,?|*/%^$#@[]()&"  # as per JQL spec + some reverse engineering
+MIN_MATCH_RATIO = 0.95
+FINGERPRINT_FRAME_COUNT = 5
 
 """
 This is the base-class with views
@@ -31,10 +42,35 @@ _JIRA_URI_CREATE_UPDATE = urljoin(JIRA_URI, '/rest/api/latest/issue')
 _JIRA_USER_PASSWD = (JIRA_USER, JIRA_PASSWD)
 _JIRA_FIELDS = ['id', 'key', 'created', 'status', 'labels', 'summary', 'description', 'environment']
 _CONTENT_JSON_HEADER = {'Content-Type': 'application/json'}
+_JIRA_DEDUP_FIELDS = ['key', 'status', 'environment', 'description']  # Only what duplicate detection needs
 _JIRA_TRANSITION_REOPEN_ID = '3'
-
-REGEX_CAUSED_BY = re.compile(r'\W*caused\W+by', re.IGNORECASE)
+_JIRA_STATUS_OPEN = 'Open'
+_JIRA_STATUS_REOPENED = 'Reopened'
+_JIRA_FINGERPRINT_LABEL_PREFIX = 'fp:'
+_DETAILS_EXCLUDED_KEYS = frozenset(['stacktrace', 'screenshots', 'logs'])
+_JIRA_MAX_CONCURRENT_REQUESTS = 8
+
+_JIRA_EXECUTOR = ThreadPoolExecutor(max_workers=_JIRA_MAX_CONCURRENT_REQUESTS)
+# Separate pool, so transitions don't queue up behind the pages of a large search from another request
+_JIRA_TRANSITION_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Recently seen exceptions by fingerprint, expire quickly as the issues might be changed in Jira meanwhile
+_DUPLICATE_CACHE = TTLCache(maxsize=1024, ttl=60)
+_DUPLICATE_CACHE_LOCK = threading.Lock()
+
+# Shared session so connections to Jira are kept alive and reused across calls (and pagination threads).
+# Content-Type is set per call, a session wide JSON content type would break the multipart attachment uploads.
+_JIRA_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3))
+_SESSION = requests.Session()
+_SESSION.auth = _JIRA_USER_PASSWD
+_SESSION.mount('https://', _JIRA_ADAPTER)
+_SESSION.mount('http://', _JIRA_ADAPTER)
+
+REGEX_CAUSED_BY = re.compile(r'\s*caused\s+by', re.IGNORECASE)
 REGEX_COUNT = re.compile(r'.*count:\s+(\d+)', re.IGNORECASE)
+REGEX_WHITESPACE = re.compile(r'\s+')
+REGEX_EXCEPTION_CLASS = re.compile(r'[\w$.]+')
+REGEX_STACKTRACE_NOISE = re.compile(r':\d+(?=\))|0x[0-9a-f]+|@[0-9a-f]{6,}', re.IGNORECASE)
 
 
 class InternalError(Exception):
@@ -63,31 +99,41 @@ def receive_exception():
 def show_all_open_issues():
     query = {'jql': 'project={}&status in (Open,"In Progress",Reopened)&issuetype=Bevinding'.format(JIRA_PROJECT),
              'fields': _JIRA_FIELDS}
-    resp = requests.post(_JIRA_URI_SEARCH,
+    resp = _SESSION.post(_JIRA_URI_SEARCH,
                          json=query,
-                         headers=_CONTENT_JSON_HEADER,
-                         auth=_JIRA_USER_PASSWD)
+                         headers=_CONTENT_JSON_HEADER)
 
     if resp.status_code != 200:
         raise InternalError('Could not get open Jira issues. HTTP response code {} : {}'.format(resp.status_code, resp.content))
 
-    return resp.json()
+    return parse_json_response(resp)
 
 
 def add_jira_exception(json_data):
     log_received_json_without_binary(json_data)
 
-    is_duplicate = determine_if_duplicate(json_data)
+    summary = get_summary_from_message(json_data)
+    stacktrace = get_stacktrace_from_message(json_data)
+    fingerprint = fingerprint_stacktrace(stacktrace)
+    is_duplicate = determine_if_duplicate(summary, stacktrace, fingerprint)
 
     if is_duplicate[0]:
         issue_id = is_duplicate[1]
-        update_to_jira(issue_id, calculate_issue_occurrence_count(is_duplicate[3]), is_issue_closed(is_duplicate[2]))
-        update_issue_with_attachments(json_data, issue_id)
+        environment = calculate_issue_occurrence_count(is_duplicate[3])
+        try:
+            is_reopened = update_to_jira(issue_id, environment, is_issue_closed(is_duplicate[2]), fingerprint)
+        except InternalError:
+            # Issue might be gone or moved, so don't keep on trying to update it for every occurrence
+            evict_cached_duplicate(fingerprint)
+            raise
+        cache_duplicate(fingerprint, issue_id, _JIRA_STATUS_REOPENED if is_reopened else is_duplicate[2], environment)
+        update_issue_with_attachments(json_data, stacktrace, issue_id)
         return 'Jira issue already exists, updated: {}'.format(issue_id)
 
-    result = add_to_jira(get_summary_from_message(json_data), create_details_string_from_json(json_data), get_stacktrace_from_message(json_data))
+    result = add_to_jira(summary, create_details_string_from_json(json_data), stacktrace, fingerprint)
     issue_id = result['key']
-    update_issue_with_attachments(json_data, issue_id)
+    cache_duplicate(fingerprint, issue_id, _JIRA_STATUS_OPEN, None)
+    update_issue_with_attachments(json_data, stacktrace, issue_id)
     return 'Jira issue added: {}'.format(issue_id), 201, {}
 
 
@@ -103,8 +149,8 @@ def log_received_json_without_binary(json_data):
     log.info('\n\n----------\nReceived json data: {}'.format(json.dumps(dict_without_binary)))
 
 
-def update_issue_with_attachments(json_data, issue_id):
-    add_attachment(get_stacktrace_from_message(json_data), 'text', 'stacktrace.txt', issue_id)
+def update_issue_with_attachments(json_data, stacktrace, issue_id):
+    add_attachment(stacktrace, 'text', 'stacktrace.txt', issue_id)
 
     if 'logs' in json_data:
         add_attachment(base64.b64decode(json_data['logs']), 'binary', 'logfiles.zip', issue_id)
@@ -129,24 +175,103 @@ def calculate_issue_occurrence_count(existing_count):
     return 'Count: {}\nLast: {}'.format(count, datetime.now())
 
 
-def determine_if_duplicate(json_data):
-    exception_summary = get_summary_from_message(json_data)
-    issue_list = find_existing_jira_issues(exception_summary)
+def determine_if_duplicate(exception_summary, new_stacktrace, fingerprint):
+    cached_duplicate = get_cached_duplicate(fingerprint)
+    if cached_duplicate is not None:
+        log.info('\nRecently seen as issue {}'.format(cached_duplicate[1]))
+        return cached_duplicate
+
+    # Exact fingerprint match is a single indexed lookup in Jira, only fall back to fuzzy matching on a miss
+    issue = find_jira_issue_by_fingerprint(fingerprint)
+    if issue is not None:
+        log.info('\nFingerprint match for issue {}'.format(issue['key']))
+        return True, issue['key'], issue['fields']['status']['name'], issue['fields']['environment']
+
+    new_normalized_stacktrace = normalize_stacktrace(new_stacktrace)
+    new_throw_location = first_line_caused_by_from_printed_stacktrace(new_stacktrace)
+    with closing(find_existing_jira_issue_pages(exception_summary)) as issue_pages:
+        for issue_list in issue_pages:
+            issue = find_duplicate_in_issues(issue_list, new_stacktrace, new_normalized_stacktrace, new_throw_location)
+            if issue is not None:
+                return True, issue['key'], issue['fields']['status']['name'], issue['fields']['environment']
+
+    return False, ''
+
 
-    new_stacktrace = get_stacktrace_from_message(json_data)
+def find_duplicate_in_issues(issue_list, new_stacktrace, new_normalized_stacktrace, new_throw_location):
+    candidates = []
     for issue in issue_list:
         issue_stacktrace = get_stacktrace_from_issue(issue)
-        new_trimmed_stacktrace = new_stacktrace[:len(issue_stacktrace)]  # Trim to same length as Jira issue might have been trimmed
-        s = SequenceMatcher(lambda x: x == ' ' or x == '\n' or x == '\t',
-                            new_trimmed_stacktrace,
-                            issue_stacktrace)
+        if len(issue_stacktrace) == 0:
+            continue
 
-        match_ratio = s.ratio() if s.real_quick_ratio() > 0.6 else 0
-        if len(issue_stacktrace) > 0 and match_ratio > 0.95 and matches_exception_throw_location(new_trimmed_stacktrace, issue_stacktrace):
-            log.info('\nMatch ratio: {} for stacktrace:\n{}'.format(match_ratio, issue_stacktrace))
-            return True, issue['key'], issue['fields']['status']['name'], issue['fields']['environment']
+        if len(issue_stacktrace) < len(new_stacktrace):
+            # Trim to same length as Jira issue might have been trimmed
+            new_trimmed_stacktrace = new_stacktrace[:len(issue_stacktrace)]
+            new_normalized_trimmed_stacktrace = normalize_stacktrace(new_trimmed_stacktrace)
+        else:
+            new_trimmed_stacktrace = new_stacktrace
+            new_normalized_trimmed_stacktrace = new_normalized_stacktrace
+
+        issue_normalized_stacktrace = normalize_stacktrace(issue_stacktrace)
+        if upper_bound_ratio(new_normalized_trimmed_stacktrace, issue_normalized_stacktrace) < MIN_MATCH_RATIO:
+            continue
+
+        candidates.append((issue, issue_stacktrace, new_trimmed_stacktrace, new_normalized_trimmed_stacktrace, issue_normalized_stacktrace))
+
+    if len(candidates) == 0:
+        return None
+
+    # Score all candidates pairwise in one native call, spread over all cores. The score cutoff makes
+    # rapidfuzz bail out early (scoring 0) once the threshold can no longer be reached
+    match_ratios = process.cpdist([candidate[3] for candidate in candidates],
+                                  [candidate[4] for candidate in candidates],
+                                  scorer=Indel.normalized_similarity,
+                                  score_cutoff=MIN_MATCH_RATIO,
+                                  workers=-1)
+
+    # Best match first, but a close match still has to be thrown from the same location
+    for i in sorted(range(len(candidates)), key=lambda i: match_ratios[i], reverse=True):
+        if match_ratios[i] <= MIN_MATCH_RATIO:
+            break
+
+        issue, issue_stacktrace, new_trimmed_stacktrace = candidates[i][:3]
+        # Throw location of the untrimmed stacktrace is already known, only a trimmed one needs another look
+        new_trimmed_throw_location = new_throw_location if new_trimmed_stacktrace is new_stacktrace \
+            else first_line_caused_by_from_printed_stacktrace(new_trimmed_stacktrace)
+        if matches_exception_throw_location(new_trimmed_throw_location, issue_stacktrace):
+            log.info('\nMatch ratio: {} for stacktrace:\n{}'.format(match_ratios[i], issue_stacktrace))
+            return issue
+
+    return None
+
+
+def get_cached_duplicate(fingerprint):
+    with _DUPLICATE_CACHE_LOCK:
+        cached_duplicate = _DUPLICATE_CACHE.get(fingerprint)
+        return tuple(cached_duplicate) if cached_duplicate is not None else None
+
+
+def cache_duplicate(fingerprint, issue_id, status, environment):
+    # Store what we just wrote to Jira, so a burst of the same exception doesn't need to look it up again
+    with _DUPLICATE_CACHE_LOCK:
+        cached_duplicate = _DUPLICATE_CACHE.get(fingerprint)
+        if cached_duplicate is None:
+            _DUPLICATE_CACHE[fingerprint] = [True, issue_id, status, environment]
+        else:
+            # Update in place, assigning again would restart the TTL and the entry would never expire during a burst
+            cached_duplicate[:] = [True, issue_id, status, environment]
 
-    return False, ''
+
+def evict_cached_duplicate(fingerprint):
+    with _DUPLICATE_CACHE_LOCK:
+        _DUPLICATE_CACHE.pop(fingerprint, None)
+
+
+def upper_bound_ratio(a, b):
+    # Best possible match ratio given only the lengths, i.e. when the shorter string is fully contained in the longer
+    total_length = len(a) + len(b)
+    return 2.0 * min(len(a), len(b)) / total_length if total_length > 0 else 1.0
 
 
 def sanitize_jql_summary(raw, trim_for_query=False):
@@ -183,22 +308,81 @@ def trim_whitespace(input):
     return re.sub('\s+', ' ', input).strip()
 
 
-def find_existing_jira_issues(exception_summary, start_at=0):
-    query = {'jql': "project={}&issuetype=Bevinding&summary ~ '{}'".format(JIRA_PROJECT, sanitize_jql_summary(exception_summary, True)),
+def normalize_stacktrace(stacktrace):
+    # Drop line numbers, pointers and object hashes, and collapse whitespace, so that only
+    # real differences count against the match ratio (which also gets cheaper on shorter input)
+    return REGEX_WHITESPACE.sub(' ', REGEX_STACKTRACE_NOISE.sub('', stacktrace))
+
+
+def find_existing_jira_issue_pages(exception_summary):
+    jql = create_duplicate_search_jql(exception_summary)
+    first_page = fetch_jira_issues_page(jql, 0)
+    yield first_page['issues']
+
+    # Only when the caller wants more than the first page, fetch all remaining pages concurrently
+    max_results = first_page['maxResults']
+    total_results = first_page['total']
+    if max_results > 0:
+        next_pages = [_JIRA_EXECUTOR.submit(fetch_jira_issues_page, jql, start_at)
+                      for start_at in range(max_results, total_results, max_results)]
+        try:
+            for page in next_pages:
+                yield page.result()['issues']
+        finally:
+            # Caller stopped early (e.g. duplicate found), don't bother fetching pages that haven't started yet
+            for page in next_pages:
+                page.cancel()
+
+
+def create_duplicate_search_jql(exception_summary):
+    jql_summary = sanitize_jql_summary(exception_summary, True)
+    # Search the summary as a phrase, otherwise '~' matches issues sharing any single word
+    jql = "project={}&issuetype=Bevinding&summary ~ '\"{}\"'".format(JIRA_PROJECT, escape_jql_string(jql_summary))
+
+    # Narrow down further on the exception class, which is in the stacktrace of every real duplicate. Take it from
+    # the raw summary, as the stacktrace in the description isn't sanitized either (e.g. 'Outer$InnerException')
+    exception_class, separator, _ = exception_summary.partition(':')
+    exception_class = exception_class.strip()
+    if separator and REGEX_EXCEPTION_CLASS.fullmatch(exception_class):
+        jql += "&description ~ '\"{}\"'".format(escape_jql_string(exception_class))
+
+    return jql
+
+
+def escape_jql_string(input):
+    return input.replace('\\', '\\\\').replace("'", "\\'").replace('"', '\\"')
+
+
+def fetch_jira_issues_page(jql, start_at):
+    query = {'jql': jql,
              'startAt': str(start_at),
-             'fields': _JIRA_FIELDS}
-    resp = requests.post(_JIRA_URI_SEARCH,
+             'fields': _JIRA_DEDUP_FIELDS}
+    resp = _SESSION.post(_JIRA_URI_SEARCH,
                          json=query,
-                         headers=_CONTENT_JSON_HEADER,
-                         auth=_JIRA_USER_PASSWD)
+                         headers=_CONTENT_JSON_HEADER)
     if resp.status_code != 200:
         raise InternalError('Could not query Jira issues, cancel processing issue. HTTP response code {} : {}'.format(resp.status_code, resp.content))
 
-    max_results = resp.json()['maxResults']
-    total_results = resp.json()['total']
-    issue_list = find_existing_jira_issues(exception_summary, start_at + max_results) if total_results > start_at + max_results else list()
+    return parse_json_response(resp)
 
-    return issue_list + resp.json()['issues']
+
+def find_jira_issue_by_fingerprint(fingerprint):
+    query = {'jql': 'project={}&issuetype=Bevinding&labels = "{}{}"'.format(JIRA_PROJECT, _JIRA_FINGERPRINT_LABEL_PREFIX, fingerprint),
+             'maxResults': 1,
+             'fields': _JIRA_DEDUP_FIELDS}
+    resp = _SESSION.post(_JIRA_URI_SEARCH,
+                         json=query,
+                         headers=_CONTENT_JSON_HEADER)
+    if resp.status_code != 200:
+        raise InternalError('Could not query Jira issues, cancel processing issue. HTTP response code {} : {}'.format(resp.status_code, resp.content))
+
+    issues = parse_json_response(resp)['issues']
+    return issues[0] if len(issues) > 0 else None
+
+
+def parse_json_response(resp):
+    # Search results carry full descriptions and can be large, orjson decodes those considerably faster
+    return orjson.loads(resp.content)
 
 
 def get_stacktrace_from_issue(issue):
@@ -210,104 +394,141 @@ def get_stacktrace_from_issue(issue):
         return ''
 
 
-def matches_exception_throw_location(new_stacktrace, issue_stacktrace):
-    line_new_stacktrace = first_line_caused_by_from_printed_stacktrace(new_stacktrace)
+def matches_exception_throw_location(new_throw_location, issue_stacktrace):
     line_issue_stacktrace = first_line_caused_by_from_printed_stacktrace(issue_stacktrace)
 
-    return line_new_stacktrace == line_issue_stacktrace
+    return new_throw_location == line_issue_stacktrace
 
 
 def first_line_caused_by_from_printed_stacktrace(printed_stacktrace):
     lines = printed_stacktrace.splitlines()
-    loc_last_causedby_line = -1
-    for i in range(len(lines)):
-        if REGEX_CAUSED_BY.match(lines[i]):
-            loc_last_causedby_line = i
+    loc_last_causedby_line = find_last_caused_by_line(lines)
+    if loc_last_causedby_line + 1 >= len(lines):
+        return ''  # No frames after the last 'caused by', e.g. when it only had native methods
 
     # Split at the colon, first element of tuple contains entire string if colon not found
     exception_line = lines[loc_last_causedby_line + 1].partition(':')
     return exception_line[0]
 
 
-def create_details_string_from_json(json_data):
-    dict_without_attachments = deepcopy(json_data)
+def find_last_caused_by_line(lines):
+    # Search backwards, the last 'caused by' is the one we're after
+    for i in range(len(lines) - 1, -1, -1):
+        # Cheap substring test first, nearly all lines are plain 'at ...' frames
+        if 'caused' in lines[i].lower() and REGEX_CAUSED_BY.match(lines[i]):
+            return i
+
+    return -1
 
-    if 'stacktrace' in dict_without_attachments:
-        del dict_without_attachments['stacktrace']
 
-    if 'screenshots' in dict_without_attachments:
-        del dict_without_attachments['screenshots']
+def fingerprint_stacktrace(printed_stacktrace):
+    # Line numbers change with every release (and pointers or hashes with every run), so leave them out
+    lines = REGEX_STACKTRACE_NOISE.sub('', printed_stacktrace).splitlines()
+    loc_last_causedby_line = find_last_caused_by_line(lines)
 
-    if 'logs' in dict_without_attachments:
-        del dict_without_attachments['logs']
+    # Use only the exception class of the original exception, its message might contain variable data
+    exception_class = lines[loc_last_causedby_line].partition(':')[2].partition(':')[0].strip() if loc_last_causedby_line >= 0 else ''
+    # Only the 'at ...' frames, lines of a multi-line exception message might contain variable data as well
+    frames = (line for line in lines[loc_last_causedby_line + 1:] if line.lstrip().startswith('at '))
+    top_frames = list(islice(frames, FINGERPRINT_FRAME_COUNT))
 
-    output = ''
-    for key, value in dict_without_attachments.items():
-        output += '  {}: {}\n'.format(key, value)
+    normalized = '\n'.join([exception_class] + [trim_whitespace(frame) for frame in top_frames])
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:16]
 
-    return output
+
+def create_details_string_from_json(json_data):
+    # Stacktrace and attachments are added to the issue separately, leave them out of the details
+    return ''.join(f'  {key}: {value}\n' for key, value in json_data.items() if key not in _DETAILS_EXCLUDED_KEYS)
 
 
 def get_summary_from_message(json_data):
     # Get the original exception, which is the last in the list
     stacks = json_data['stacktrace']
-    return stacks[len(stacks) - 1]['message']
+    return stacks[-1]['message']
 
 
 def get_stacktrace_from_message(json_data):
-    traces = json_data['stacktrace']
-    output = io.StringIO()
-    for trace in traces:
-        output.write('Caused by: {}\n'.format(trace['message']))
+    parts = []
+    append = parts.append
+    for trace in json_data['stacktrace']:
+        append(f"Caused by: {trace['message']}\n")
         for line in trace['stacktrace']:
             if not line['nativeMethod']:  # Filter out native Java methods
-                output.write('\tat {}.{}({}:{})\n'.format(line['className'], line['methodName'], line['fileName'], line['lineNumber']))
+                append(f"\tat {line['className']}.{line['methodName']}({line['fileName']}:{line['lineNumber']})\n")
 
-    result = output.getvalue()
-    output.close()
-    return result
+    return ''.join(parts)
 
 
-def add_to_jira(summary, details, stacktrace):
+def add_to_jira(summary, details, stacktrace, fingerprint):
     summary = sanitize_jql_summary(summary)
     title = '{}: {}'.format(JIRA_ISSUE_TITLE, summary)
     description = '{}\n\nDetails:\n{}\n\nStacktrace:\n{{noformat}}{}{{noformat}}'.format(summary, details, trim_length(stacktrace, MAX_DESCRIPTION_LENGTH))
     issue = {'project': {'key': '{}'.format(JIRA_PROJECT)}, 'summary': title, 'description': description,
-             'issuetype': {'name': 'Bevinding'}, 'labels': ['Beheer']}
+             'issuetype': {'name': 'Bevinding'}, 'labels': ['Beheer', _JIRA_FINGERPRINT_LABEL_PREFIX + fingerprint]}
     fields = {'fields': issue}
 
-    log.info('Sending:\n{}'.format(json.dumps(fields)))
-
-    resp = requests.post(_JIRA_URI_CREATE_UPDATE,
-                         json=fields,
-                         headers=_CONTENT_JSON_HEADER,
-                         auth=_JIRA_USER_PASSWD)
+    payload = serialize_json_payload(fields)
+    resp = _SESSION.post(_JIRA_URI_CREATE_UPDATE,
+                         data=payload,
+                         headers=_CONTENT_JSON_HEADER)
     if resp.status_code != 201:
         raise InternalError('Could not create new Jira issue. HTTP response code {} : {}'.format(resp.status_code, resp.content))
 
     return resp.json()
 
 
-def update_to_jira(issue_id, environment, do_status_transition):
-    updated_fields = {'environment': [{'set': environment}]}
+def update_to_jira(issue_id, environment, do_status_transition, fingerprint):
+    # Also label issues found through fuzzy matching, so the next occurrence is found by fingerprint directly
+    updated_fields = {'environment': [{'set': environment}], 'labels': [{'add': _JIRA_FINGERPRINT_LABEL_PREFIX + fingerprint}]}
     fields = {'update': updated_fields}
 
-    log.info('Sending:\n{}'.format(json.dumps(fields)))
-    resp = requests.put(urljoin(_JIRA_URI_CREATE_UPDATE + '/', issue_id),
-                        json=fields,
-                        headers=_CONTENT_JSON_HEADER,
-                        auth=_JIRA_USER_PASSWD)
+    # The status transition doesn't depend on the field update, so let it run alongside instead of after it
+    transition = _JIRA_TRANSITION_EXECUTOR.submit(transition_jira_issue, issue_id, _JIRA_TRANSITION_REOPEN_ID) if do_status_transition else None
+
+    try:
+        payload = serialize_json_payload(fields)
+        resp = _SESSION.put(urljoin(_JIRA_URI_CREATE_UPDATE + '/', issue_id),
+                            data=payload,
+                            headers=_CONTENT_JSON_HEADER)
+
+        if resp.status_code != 204:
+            raise InternalError('Could not update existing Jira issue. HTTP response code {} : {}'.format(resp.status_code, resp.content))
+    finally:
+        # Also when the update failed, the transition might already have been done so always report its outcome
+        is_transitioned = transition is not None and wait_for_transition(issue_id, transition)
+
+    return is_transitioned
+
+
+def wait_for_transition(issue_id, transition):
+    try:
+        resp = transition.result()
+    except requests.RequestException as err:
+        log.error('Could not transition Jira issue {}:'.format(issue_id), exc_info=err)
+        return False
 
     if resp.status_code != 204:
-        raise InternalError('Could not update existing Jira issue. HTTP response code {} : {}'.format(resp.status_code, resp.content))
+        log.error('Could not transition Jira issue {}. HTTP response code {} : {}'.format(issue_id, resp.status_code, resp.content))
+        return False
+
+    log.debug('Transition response: ' + resp.text)
+    return True
+
+
+def transition_jira_issue(issue_id, transition_id):
+    log.info('Update issue status to: {}'.format(transition_id))
+    return _SESSION.post(urljoin(_JIRA_URI_CREATE_UPDATE + '/', issue_id + '/transitions'),
+                         json={'transition': {'id': transition_id}},
+                         headers=_CONTENT_JSON_HEADER)
+
+
+def serialize_json_payload(fields):
+    # Serialize only once, for both logging and sending. Issue descriptions with stacktraces can be large
+    payload = orjson.dumps(fields)
+    if log.isEnabledFor(logging.INFO):
+        log.info('Sending:\n{}'.format(payload.decode('utf-8')))
 
-    if do_status_transition:
-        log.info('Update issue status to: {}'.format(_JIRA_TRANSITION_REOPEN_ID))
-        resp = requests.post(urljoin(_JIRA_URI_CREATE_UPDATE + '/', issue_id + '/transitions'),
-                             json={'transition': {'id': _JIRA_TRANSITION_REOPEN_ID}},
-                             headers=_CONTENT_JSON_HEADER,
-                             auth=_JIRA_USER_PASSWD)
-        log.debug('Transition response: ' + resp.text)
+    return payload
 
 
 def add_attachment(attachment, type, filename, issue_id):
@@ -318,9 +539,8 @@ def add_attachment(attachment, type, filename, issue_id):
         url = urljoin(_JIRA_URI_CREATE_UPDATE + '/', issue_id + '/attachments')
         log.info('Posting attachment to {}'.format(url))
 
-        response = requests.post(url,
+        response = _SESSION.post(url,
                                  headers={'X-Atlassian-Token': 'no-check'},
-                                 auth=_JIRA_USER_PASSWD,
                                  files=files)
 
         log.info('Response for posting attachment to {}: {}'.format(url, response))
@@ -0,0 +1,7 @@
+import os
+
+# The service reads its Jira settings on import, provide dummy ones before any test imports it
+os.environ.setdefault('JIRA_URL', 'https://jira.example.com')
+os.environ.setdefault('JIRA_USER', 'user')
+os.environ.setdefault('JIRA_PASSWD', 'passwd')
+os.environ.setdefault('JIRA_PROJECT', 'PRJ')
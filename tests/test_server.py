@@ -0,0 +1,154 @@
+import unittest
+from unittest import mock
+
+from cachetools import TTLCache
+
+from exceptionservice import server
+from exceptionservice.server import create_duplicate_search_jql
+
+
+def create_exception_message(message='java.lang.IllegalStateException: bad state', frame_count=3):
+    frames = [{'className': 'com.example.Service', 'methodName': 'call{}'.format(i), 'fileName': 'Service.java',
+               'lineNumber': 10 + i, 'nativeMethod': False} for i in range(frame_count)]
+    return {'stacktrace': [{'message': message, 'stacktrace': frames}], 'version': '1.0'}
+
+
+def create_response(status_code, content=b''):
+    return mock.Mock(status_code=status_code, content=content, text=content.decode('utf-8'))
+
+
+class CreateDuplicateSearchJqlTest(unittest.TestCase):
+
+    def test_searches_summary_as_phrase_and_exception_class_in_description(self):
+        jql = create_duplicate_search_jql('java.lang.IllegalStateException: bad state')
+
+        self.assertEqual("project=PRJ&issuetype=Bevinding&summary ~ '\"java.lang.IllegalStateException: bad state\"'"
+                         "&description ~ '\"java.lang.IllegalStateException\"'", jql)
+
+    def test_keeps_inner_class_exception_name_unsanitized(self):
+        jql = create_duplicate_search_jql('com.example.Outer$InnerException: boom')
+
+        self.assertIn("summary ~ '\"com.example.OuterInnerException: boom\"'", jql)
+        self.assertIn("description ~ '\"com.example.Outer$InnerException\"'", jql)
+
+    def test_skips_description_without_exception_class(self):
+        self.assertNotIn('description', create_duplicate_search_jql('Something went wrong'))
+        self.assertNotIn('description', create_duplicate_search_jql('Request (id 5) failed: timeout'))
+
+    def test_escapes_backslashes(self):
+        jql = create_duplicate_search_jql('java.io.IOException: no access to \\\\server\\share')
+
+        self.assertIn("summary ~ '\"java.io.IOException: no access to \\\\\\\\server\\\\share\"'", jql)
+
+
+
+class FirstLineCausedByTest(unittest.TestCase):
+
+    def test_returns_throw_location_of_root_cause(self):
+        printed_stacktrace = ('Caused by: java.lang.RuntimeException: wrapper\n'
+                              '\tat com.example.Outer.run(Outer.java:10)\n'
+                              'Caused by: java.lang.IllegalStateException: bad\n'
+                              '\tat com.example.Inner.call(Inner.java:20)\n')
+
+        self.assertEqual('\tat com.example.Inner.call(Inner.java',
+                         server.first_line_caused_by_from_printed_stacktrace(printed_stacktrace))
+
+    def test_returns_empty_when_root_cause_has_no_frames(self):
+        self.assertEqual('', server.first_line_caused_by_from_printed_stacktrace('Caused by: java.lang.StackOverflowError\n'))
+
+
+class FingerprintStacktraceTest(unittest.TestCase):
+    STACKTRACE = ('Caused by: java.lang.RuntimeException: wrapper\n'
+                  '\tat com.example.Outer.run(Outer.java:10)\n'
+                  'Caused by: org.postgresql.util.PSQLException: ERROR: duplicate key\n'
+                  '  Detail: Key (id)=(5) already exists.\n'
+                  '\tat org.postgresql.Executor.receive(Executor.java:2440)\n'
+                  '\tat com.example.Dao.save(Dao.java:42)\n')
+
+    def test_ignores_line_numbers_and_message(self):
+        fingerprint = server.fingerprint_stacktrace(self.STACKTRACE)
+
+        self.assertEqual(fingerprint, server.fingerprint_stacktrace(self.STACKTRACE.replace(':42)', ':43)')))
+        self.assertEqual(fingerprint, server.fingerprint_stacktrace(self.STACKTRACE.replace('duplicate key', 'other')))
+
+    def test_ignores_multi_line_message(self):
+        self.assertEqual(server.fingerprint_stacktrace(self.STACKTRACE),
+                         server.fingerprint_stacktrace(self.STACKTRACE.replace('(id)=(5)', '(id)=(6)')))
+
+    def test_differs_for_other_exception_class_or_frames(self):
+        fingerprint = server.fingerprint_stacktrace(self.STACKTRACE)
+
+        self.assertNotEqual(fingerprint, server.fingerprint_stacktrace(self.STACKTRACE.replace('PSQLException', 'SQLException')))
+        self.assertNotEqual(fingerprint, server.fingerprint_stacktrace(self.STACKTRACE.replace('Dao.save', 'Dao.delete')))
+
+    def test_uses_root_cause_only(self):
+        self.assertEqual(server.fingerprint_stacktrace(self.STACKTRACE),
+                         server.fingerprint_stacktrace(self.STACKTRACE.replace('Outer.run', 'Other.run')))
+
+
+class NormalizeStacktraceTest(unittest.TestCase):
+
+    def test_strips_line_numbers_pointers_and_hashes(self):
+        self.assertEqual('Caused by: java.lang.IllegalStateException: handle , object com.example.Item '
+                         'at com.example.Inner.call(Inner.java) ',
+                         server.normalize_stacktrace('Caused by: java.lang.IllegalStateException: handle 0x7fA3, object com.example.Item@1b6d3586\n'
+                                                     '\tat com.example.Inner.call(Inner.java:20)\n'))
+
+    def test_keeps_other_numbers(self):
+        self.assertEqual('Caused by: java.io.IOException: port 8080 ',
+                         server.normalize_stacktrace('Caused by: java.io.IOException: port 8080\n'))
+
+
+class UpdateToJiraTest(unittest.TestCase):
+
+    def test_returns_whether_issue_was_reopened(self):
+        with mock.patch.object(server._SESSION, 'put', return_value=create_response(204)), \
+                mock.patch.object(server._SESSION, 'post', return_value=create_response(204)):
+            self.assertTrue(server.update_to_jira('PRJ-1', 'Count: 2', True, 'fp'))
+            self.assertFalse(server.update_to_jira('PRJ-1', 'Count: 2', False, 'fp'))
+
+    def test_returns_false_when_transition_fails(self):
+        with mock.patch.object(server._SESSION, 'put', return_value=create_response(204)), \
+                mock.patch.object(server._SESSION, 'post', return_value=create_response(400, b'{"errorMessages": []}')):
+            self.assertFalse(server.update_to_jira('PRJ-1', 'Count: 2', True, 'fp'))
+
+    def test_waits_for_transition_when_update_fails(self):
+        transition = create_response(204)
+        with mock.patch.object(server._SESSION, 'put', return_value=create_response(404)), \
+                mock.patch.object(server._SESSION, 'post', return_value=transition) as post:
+            self.assertRaises(server.InternalError, server.update_to_jira, 'PRJ-1', 'Count: 2', True, 'fp')
+            post.assert_called_once()
+
+
+class DuplicateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        cache = TTLCache(maxsize=16, ttl=60, timer=lambda: self.now)
+        patcher = mock.patch.object(server, '_DUPLICATE_CACHE', cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_updating_entry_keeps_expiry_of_first_insert(self):
+        server.cache_duplicate('fp', 'PRJ-1', 'Open', 'Count: 1')
+        self.now = 50
+        server.cache_duplicate('fp', 'PRJ-1', 'Open', 'Count: 2')
+
+        self.assertEqual((True, 'PRJ-1', 'Open', 'Count: 2'), server.get_cached_duplicate('fp'))
+
+        self.now = 61
+        self.assertIsNone(server.get_cached_duplicate('fp'))
+
+    def test_evicts_entry_when_updating_issue_fails(self):
+        json_data = create_exception_message()
+        fingerprint = server.fingerprint_stacktrace(server.get_stacktrace_from_message(json_data))
+        server.cache_duplicate(fingerprint, 'PRJ-1', 'Open', 'Count: 1')
+
+        with mock.patch.object(server._SESSION, 'put', return_value=create_response(404)):
+            self.assertRaises(server.InternalError, server.add_jira_exception, json_data)
+
+        self.assertIsNone(server.get_cached_duplicate(fingerprint))
+
+
+if __name__ == '__main__':
+    unittest.main()